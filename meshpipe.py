@@ -14,6 +14,11 @@
 #
 # python3 meshpipe.py --port=[usb_serial_device]
 #
+# Profiling:
+#
+# kill -USR1 [pid]  toggle stack sampler, collapsed stacks written on stop
+# kill -USR2 [pid]  dump current stack of every thread
+#
 # This work is based on:
 #
 #  https://github.com/datagod/meshwatch/
@@ -44,11 +49,15 @@ import subprocess
 import select
 import sqlite3
 import threading
+import bisect
+import operator
+import itertools
+from array import array
 from random import randrange, uniform
 # from meshtastic.mesh_pb2 import _HARDWAREMODEL
 from meshtastic.node import Node
 from pubsub import pub
-from signal import signal, SIGINT
+from signal import signal, SIGINT, SIGUSR1, SIGUSR2
 from sys import exit
 from datetime import datetime
 
@@ -59,7 +68,16 @@ DEBUG = False
 
 parser = argparse.ArgumentParser(description=DESCRIPTION)
 parser.add_argument('-p', '--port', type=str, help="meshtastic port (eg. /dev/ttyACM0)")
+parser.add_argument('--geofence', type=str, help="geofence file, trackMarkers outside are filtered (eg. /opt/edgemap-persist/geofence.txt)")
+parser.add_argument('--geofence-interval', type=float, default=0, help="seconds between passed trackMarkers per callsign outside geofence, 0 drops them (default: 0)")
+parser.add_argument('--geofence-zoom', type=int, default=8, help="tile zoom level of geofence grid (default: 8)")
+parser.add_argument('--profile-rate', type=float, default=100, help="stack sampling rate in Hz (default: 100)")
+parser.add_argument('--profile-file', type=str, default='/tmp/meshpipe.collapsed', help="collapsed stack output file (default: /tmp/meshpipe.collapsed)")
 args = parser.parse_args()
+if args.profile_rate <= 0:
+  parser.error("--profile-rate must be greater than 0")
+if not 1 <= args.geofence_zoom <= 15:
+  parser.error("--geofence-zoom must be between 1 and 15")
 
 global Interface
 global DeviceStatus
@@ -79,6 +97,32 @@ global DeviceHopLimit
 global DeviceRxRssi
 global myRadioHexId
 
+ProfilerEnabled = threading.Event()
+ProfilerSamples = collections.Counter()
+ProfilerThread  = None
+
+# Telemetry history: fixed size ring per node and metric, least
+# recently heard node is evicted, so memory is capped at
+# TELEMETRY_MAX_NODES * metrics * TELEMETRY_SAMPLES * 2 * 8 bytes
+TELEMETRY_SAMPLES   = 256
+TELEMETRY_MAX_NODES = 64
+TELEMETRY_METRICS   = ('batteryLevel', 'airUtilTx', 'rxSnr', 'rxRssi')
+TELEMETRY_WINDOW    = 3600
+TELEMETRY_TREND_MIN_SPAN = 600
+TelemetryHistory    = collections.OrderedDict()
+TelemetryLock       = threading.Lock()
+
+# Geofence: regions as (min_lat, min_lon, max_lat, max_lon, polygon).
+# Only tiles crossed by a region edge are stored, (xtile, ytile) ->
+# polygons to test exactly. Other tiles are fully inside or outside,
+# decided once by tile center and cached.
+GEOFENCE_MAX_CALLSIGNS    = 1024
+GEOFENCE_MAX_CACHED_TILES = 4096
+GeofenceRegions           = None
+GeofenceBoundary          = {}
+GeofenceInterior          = {}
+GeofenceLastAccepted   = collections.OrderedDict()
+
 
 def ErrorHandler(ErrorMessage,TraceMessage,AdditionalInfo):
   CallingFunction =  inspect.stack()[1][3]
@@ -166,6 +210,9 @@ def onReceive(packet, interface):
     fromIdent = fromIdentString[1:]
     
     if(fromIdent):
+        telemetryRecorded = telemetry_record(fromIdent, {'batteryLevel': DeviceBat, 'airUtilTx': DeviceAirUtilTx,
+                                                         'rxSnr': DeviceRxSnr, 'rxRssi': DeviceRxRssi})
+
         # print('** Packet from: {}'.format(fromIdent))
         # print('** battery: {}'.format(DeviceBat))
         # print('** air util: {}'.format( DeviceAirUtilTx ))
@@ -190,7 +237,19 @@ def onReceive(packet, interface):
         fifo_write.write(meshtasticmessage)
         fifo_write.flush()
 
+        # Telemetry history for trend displays
+        if telemetryRecorded:
+            meshtasticmessage = "peertelemetry," + fromIdent + "," + telemetry_summary(fromIdent)
+            fifo_write = open('/tmp/statusin', 'w')
+            fifo_write.write(meshtasticmessage)
+            fifo_write.flush()
+
     if(Message):
+        # Filter trackMarkers outside geofence before FIFO and DB
+        messageFields = Message.split('|')
+        if ( len(messageFields) > 2 and messageFields[1] == "trackMarker" ):
+            if not geofence_accept(messageFields[0], messageFields[2]):
+                return
         hexFromValue = "{0:0>8X}".format(From)
         print("Incoming: {: <20} {: <20}".format(hexFromValue,Message))
         fifo_write = open('/tmp/msgchannel', 'w')
@@ -198,7 +257,6 @@ def onReceive(packet, interface):
         fifo_write.flush()
         if( fromIdent.upper() == hexFromValue ):
             # edgex|trackMarker|23.6406054,50.7603593|GPS-snapshot
-            messageFields = Message.split('|')
             if ( messageFields[1] == "trackMarker" ):            
                 messagePositionFields = messageFields[2].split(',')
                 lon = messagePositionFields[0]
@@ -208,6 +266,104 @@ def onReceive(packet, interface):
                 # print("Meshtastic data to DB: {: <10} {: <10} {: <10} {: <10} {: <10} {: <10}".format(callsign,lat,lon,hexFromValue,DeviceRxSnr,DeviceRxRssi))
                 meshtasticDbUpdate(callsign,lat,lon,"trackMarker",hexFromValue,DeviceRxSnr,DeviceRxRssi)
 
+#
+# Telemetry history
+#
+class TelemetryRing:
+  def __init__(self, size):
+    self.size   = size
+    self.head   = 0
+    self.count  = 0
+    self.times  = array('d', [0.0]) * size
+    self.values = array('d', [0.0]) * size
+
+  def append(self, timestamp, value):
+    self.times[self.head]  = timestamp
+    self.values[self.head] = value
+    self.head  = (self.head + 1) % self.size
+    self.count = min(self.count + 1, self.size)
+
+  def ordered(self, column):
+    # Oldest first
+    if self.count < self.size:
+      return column[:self.count]
+    return column[self.head:] + column[:self.head]
+
+  def window(self, seconds):
+    times = self.ordered(self.times)
+    start = bisect.bisect_left(times, time.monotonic() - seconds)
+    return (times[start:], self.ordered(self.values)[start:])
+
+def telemetry_record(nodeId, sample):
+  # Each metric has its own ring, only metrics present in the
+  # packet are stored. Returns True when something was stored.
+  present = {metric: value for metric, value in sample.items() if value is not None}
+  # batteryLevel 101 means external power, not a charge level
+  if present.get('batteryLevel', 0) > 100:
+    del present['batteryLevel']
+  if not present:
+    return False
+  # Monotonic, wall clock may jump on GPS/NTP sync
+  now = time.monotonic()
+  with TelemetryLock:
+    rings = TelemetryHistory.get(nodeId)
+    if rings is None:
+      if len(TelemetryHistory) >= TELEMETRY_MAX_NODES:
+        TelemetryHistory.popitem(last=False)
+      rings = TelemetryHistory[nodeId] = {}
+    else:
+      TelemetryHistory.move_to_end(nodeId)
+    for metric, value in present.items():
+      ring = rings.get(metric)
+      if ring is None:
+        ring = rings[metric] = TelemetryRing(TELEMETRY_SAMPLES)
+      ring.append(now, value)
+  return True
+
+def telemetry_windows(nodeId, seconds):
+  # Returns {metric: (times, values)} over last 'seconds'
+  with TelemetryLock:
+    rings = TelemetryHistory.get(nodeId, {})
+    return {metric: ring.window(seconds) for metric, ring in rings.items()}
+
+def telemetry_stats(values):
+  # Returns (min, mean, max, count) or None
+  if not values:
+    return None
+  return (min(values), math.fsum(values) / len(values), max(values), len(values))
+
+def telemetry_trend(times, values):
+  # Least squares slope in units per hour (eg. battery %/h) or None
+  # when samples span less than TELEMETRY_TREND_MIN_SPAN
+  n = len(values)
+  if ( n < 2 or times[-1] - times[0] < TELEMETRY_TREND_MIN_SPAN ):
+    return None
+  times = array('d', map(operator.sub, times, itertools.repeat(times[0])))
+  sum_t  = math.fsum(times)
+  sum_v  = math.fsum(values)
+  sum_tt = math.fsum(map(operator.mul, times, times))
+  sum_tv = math.fsum(map(operator.mul, times, values))
+  denominator = n * sum_tt - sum_t * sum_t
+  if denominator == 0:
+    return None
+  return (n * sum_tv - sum_t * sum_v) / denominator * 3600.0
+
+def telemetry_summary(nodeId):
+  # peertelemetry fields: battery min,mean,max,trend(%/h),
+  # airUtilTx mean, rxSnr mean, rxRssi mean over TELEMETRY_WINDOW
+  empty = (array('d'), array('d'))
+  windows = telemetry_windows(nodeId, TELEMETRY_WINDOW)
+  fields = []
+  times, values = windows.get('batteryLevel', empty)
+  battery = telemetry_stats(values)
+  fields += ['-', '-', '-'] if battery is None else ["{:.1f}".format(value) for value in battery[:3]]
+  trend = telemetry_trend(times, values)
+  fields.append('-' if trend is None else "{:.1f}".format(trend))
+  for metric in ('airUtilTx', 'rxSnr', 'rxRssi'):
+    stats = telemetry_stats(windows.get(metric, empty)[1])
+    fields.append('-' if stats is None else "{:.2f}".format(stats[1]))
+  return ",".join(fields)
+
 def meshtasticDbCreate():
     connection = sqlite3.connect("/tmp/radio.db")
     print(connection.total_changes)
@@ -277,6 +433,72 @@ def SIGINT_handler(signal_received, frame):
   print('SIGINT detected. \n')
   sys.exit()
 
+#
+# Profiling
+#
+# Sampler thread only exists while profiling is on, so there
+# is no cost when disabled. Output is in collapsed stack format:
+#
+# flamegraph.pl /tmp/meshpipe.collapsed > meshpipe.svg
+#
+def profiler_thread_names():
+  return {thread.ident: thread.name for thread in threading.enumerate()}
+
+def profiler_collapse_stack(frame):
+  stack = []
+  while frame is not None:
+    code = frame.f_code
+    stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+    frame = frame.f_back
+  stack.reverse()
+  return ";".join(stack)
+
+def profiler_write_collapsed():
+  samples = sum(ProfilerSamples.values())
+  try:
+    with open(args.profile_file, 'w') as collapsed_file:
+      for stack, count in ProfilerSamples.items():
+        collapsed_file.write("{} {}\n".format(stack, count))
+  except OSError as e:
+    print("Profiler: failed to write {} samples to {}: {}".format(samples, args.profile_file, e))
+    return
+  print("Profiler: {} samples written to {}".format(samples, args.profile_file))
+
+def profiler_sampler():
+  interval = 1.0 / args.profile_rate
+  own_ident = threading.get_ident()
+  while ProfilerEnabled.is_set():
+    names = profiler_thread_names()
+    for ident, frame in sys._current_frames().items():
+      if ident == own_ident:
+        continue
+      stack = names.get(ident, str(ident)) + ";" + profiler_collapse_stack(frame)
+      ProfilerSamples[stack] += 1
+    time.sleep(interval)
+  profiler_write_collapsed()
+
+def SIGUSR1_handler(signal_received, frame):
+  global ProfilerThread
+  if ProfilerEnabled.is_set():
+    print('SIGUSR1 detected, stopping profiler.')
+    ProfilerEnabled.clear()
+  else:
+    # Let previous sampler finish writing before reusing samples
+    if ProfilerThread is not None:
+      ProfilerThread.join()
+    print('SIGUSR1 detected, starting profiler at {} Hz.'.format(args.profile_rate))
+    ProfilerSamples.clear()
+    ProfilerEnabled.set()
+    ProfilerThread = threading.Thread(target=profiler_sampler, name='profiler', daemon=True)
+    ProfilerThread.start()
+
+def SIGUSR2_handler(signal_received, frame):
+  print('SIGUSR2 detected, dumping thread stacks.')
+  names = profiler_thread_names()
+  for ident, thread_frame in sys._current_frames().items():
+    print("--- Thread: {} ({}) ---".format(names.get(ident, '?'), ident))
+    print("".join(traceback.format_stack(thread_frame)), flush=True)
+
 
 #
 # Send message functions
@@ -358,7 +580,161 @@ def deg2num(lat_deg, lon_deg, zoom):
   xtile = int((lon_deg + 180.0) / 360.0 * n)
   ytile = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
   return (xtile, ytile)
-      
+
+def num2deg(xtile, ytile, zoom):
+  n = 2.0 ** zoom
+  lon_deg = xtile / n * 360.0 - 180.0
+  lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * ytile / n)))
+  lat_deg = math.degrees(lat_rad)
+  return (lat_deg, lon_deg)
+
+#
+# Geofence
+#
+# File format, one region per line (lat,lon in degrees):
+#
+# bbox,[min_lat],[min_lon],[max_lat],[max_lon]
+# polygon,[lat],[lon],[lat],[lon],[lat],[lon],...
+#
+# Regions crossing the antimeridian are not supported. When a geofence
+# is active, a trackMarker position that is not a valid lat/lon is
+# handled as outside the geofence.
+#
+def geofence_valid_position(lat, lon):
+  return ( math.isfinite(lat) and math.isfinite(lon) and -90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0 )
+
+def geofence_tile(lat, lon):
+  # Keep inside web mercator range
+  lat = max(-85.0511, min(85.0511, lat))
+  return deg2num(lat, lon, args.geofence_zoom)
+
+def geofence_edge_tiles(lat1, lon1, lat2, lon2):
+  # Walk edge through the grid: split it where it crosses tile
+  # border lines and mark tile of every piece. Tile borders are
+  # constant lat or lon, so edge stays straight in this space.
+  zoom = args.geofence_zoom
+  x1, y1 = geofence_tile(lat1, lon1)
+  x2, y2 = geofence_tile(lat2, lon2)
+  steps = [0.0, 1.0]
+  for x in range(min(x1, x2) + 1, max(x1, x2) + 1):
+    steps.append((num2deg(x, 0, zoom)[1] - lon1) / (lon2 - lon1))
+  for y in range(min(y1, y2) + 1, max(y1, y2) + 1):
+    steps.append((num2deg(0, y, zoom)[0] - lat1) / (lat2 - lat1))
+  steps.sort()
+  tiles = set()
+  for step in steps:
+    tiles.add(geofence_tile(lat1 + (lat2 - lat1) * step, lon1 + (lon2 - lon1) * step))
+  for step_a, step_b in zip(steps, steps[1:]):
+    step = (step_a + step_b) / 2
+    tiles.add(geofence_tile(lat1 + (lat2 - lat1) * step, lon1 + (lon2 - lon1) * step))
+  return tiles
+
+def point_in_polygon(lat, lon, polygon):
+  inside = False
+  j = len(polygon) - 1
+  for i in range(len(polygon)):
+    lat_i, lon_i = polygon[i]
+    lat_j, lon_j = polygon[j]
+    if ( (lat_i > lat) != (lat_j > lat) ):
+      if ( lon < (lon_j - lon_i) * (lat - lat_i) / (lat_j - lat_i) + lon_i ):
+        inside = not inside
+    j = i
+  return inside
+
+def geofence_add_polygon(boundary, polygon):
+  # Only tiles crossed by an edge are stored, they need exact test
+  for i in range(len(polygon)):
+    lat_i, lon_i = polygon[i - 1]
+    lat_j, lon_j = polygon[i]
+    for tile in geofence_edge_tiles(lat_i, lon_i, lat_j, lon_j):
+      if polygon not in boundary.get(tile, ()):
+        boundary[tile] = boundary.get(tile, ()) + (polygon,)
+
+def geofence_load(path):
+  global GeofenceRegions
+  global GeofenceBoundary
+  regions  = []
+  boundary = {}
+  with open(path, 'r') as geofence_file:
+    for line in geofence_file:
+      line = line.strip()
+      if line == "" or line.startswith('#'):
+        continue
+      fields = line.split(',')
+      try:
+        coordinates = [float(value) for value in fields[1:]]
+      except ValueError:
+        raise ValueError("Invalid geofence line: {}".format(line))
+      polygon = None
+      if ( fields[0] == "bbox" and len(coordinates) == 4 ):
+        min_lat, min_lon, max_lat, max_lon = coordinates
+        if ( min_lat < max_lat and min_lon < max_lon ):
+          polygon = ((min_lat, min_lon), (min_lat, max_lon), (max_lat, max_lon), (max_lat, min_lon))
+      elif ( fields[0] == "polygon" and len(coordinates) >= 6 and len(coordinates) % 2 == 0 ):
+        polygon = tuple(zip(coordinates[0::2], coordinates[1::2]))
+      if ( polygon is None or not all(geofence_valid_position(lat, lon) for lat, lon in polygon) ):
+        raise ValueError("Invalid geofence line: {}".format(line))
+      geofence_add_polygon(boundary, polygon)
+      lats = [lat for lat, lon in polygon]
+      lons = [lon for lat, lon in polygon]
+      regions.append((min(lats), min(lons), max(lats), max(lons), polygon))
+  GeofenceRegions  = regions
+  GeofenceBoundary = boundary
+  GeofenceInterior.clear()
+  print("Geofence: {} regions, {} boundary tiles from {}".format(len(regions), len(boundary), path))
+
+def geofence_tile_inside(tile):
+  # A region without an edge in this tile covers it fully or
+  # not at all, so its tile center decides
+  boundary = GeofenceBoundary.get(tile, ())
+  center_lat, center_lon = num2deg(tile[0] + 0.5, tile[1] + 0.5, args.geofence_zoom)
+  for min_lat, min_lon, max_lat, max_lon, polygon in GeofenceRegions:
+    if ( min_lat <= center_lat <= max_lat and min_lon <= center_lon <= max_lon ):
+      if ( polygon not in boundary and point_in_polygon(center_lat, center_lon, polygon) ):
+        return True
+  return False
+
+def geofence_contains(lat, lon):
+  tile = geofence_tile(lat, lon)
+  inside = GeofenceInterior.get(tile)
+  if inside is None:
+    inside = geofence_tile_inside(tile)
+    if len(GeofenceInterior) >= GEOFENCE_MAX_CACHED_TILES:
+      GeofenceInterior.clear()
+    GeofenceInterior[tile] = inside
+  if inside:
+    return True
+  for polygon in GeofenceBoundary.get(tile, ()):
+    if point_in_polygon(lat, lon, polygon):
+      return True
+  return False
+
+def geofence_accept(callsign, position):
+  if GeofenceRegions is None:
+    return True
+  # trackMarker position is lon,lat
+  try:
+    lon, lat = position.split(',')[:2]
+    lat = float(lat)
+    lon = float(lon)
+  except ValueError:
+    lat = lon = math.nan
+  if ( geofence_valid_position(lat, lon) and geofence_contains(lat, lon) ):
+    return True
+  # Outside: drop or pass at low rate
+  if args.geofence_interval <= 0:
+    return False
+  # Monotonic, wall clock may jump on GPS/NTP sync
+  now = time.monotonic()
+  last = GeofenceLastAccepted.get(callsign)
+  if ( last is not None and now - last < args.geofence_interval ):
+    return False
+  GeofenceLastAccepted[callsign] = now
+  GeofenceLastAccepted.move_to_end(callsign)
+  if len(GeofenceLastAccepted) > GEOFENCE_MAX_CALLSIGNS:
+    GeofenceLastAccepted.popitem(last=False)
+  return True
+
 # TODO: Deliver nodes to fifo or create mesh status fifo for UI?
 
 def DisplayNodes(interface):
@@ -617,6 +993,10 @@ def main():
   global BaseLat
   global BaseLon
 
+  # Profiling signals, before any device I/O that may stall
+  signal(SIGUSR1, SIGUSR1_handler)
+  signal(SIGUSR2, SIGUSR2_handler)
+
   try:
 
     DeviceName      = '??'
@@ -664,6 +1044,9 @@ def main():
     #
     meshtasticDbCreate()
 
+    if args.geofence:
+        geofence_load(args.geofence)
+
 
     print("Connecting to device at port {}".format(args.port))
     interface = meshtastic.serial_interface.SerialInterface(args.port)
@@ -682,9 +1065,9 @@ def main():
     DisplayNodes(interface)
 
     # Launch threads
-    t1 = threading.Thread(target=read_live_gps, args=())
-    t2 = threading.Thread(target=read_manual_gps, args=()) 
-    t3 = threading.Thread(target=read_incoming_fifo, args=()) 
+    t1 = threading.Thread(target=read_live_gps, args=(), name='read_live_gps')
+    t2 = threading.Thread(target=read_manual_gps, args=(), name='read_manual_gps') 
+    t3 = threading.Thread(target=read_incoming_fifo, args=(), name='read_incoming_fifo') 
     t1.start()
     t2.start()
     t3.start()